@@ -1,26 +1,44 @@
 """Backend server for Ricochet game."""
 
 import asyncio
+import contextlib
 import dataclasses
 import enum
+import functools
 import logging
 
-import websockets
-from fastapi import FastAPI, WebSocket
+import msgpack
+import orjson
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse
 
 logger = logging.getLogger(__name__)
 
-room_list_modified = asyncio.Event()
 
-@dataclasses.dataclass
+@functools.cache
+def room_list_modified() -> asyncio.Event:
+    """Returns the event to notify a modification of the room list.
+
+    The event is created on the first call instead of at import time, so that it is created
+    inside the running event loop. The cache is cleared whenever the app starts, so that each
+    event loop running the app gets its own event.
+    """
+    return asyncio.Event()
+
+
+@dataclasses.dataclass(slots=True)
 class RoomInfo:
     """Container of room information.
     
     Fields:
         name: The room name.
         owner_id: The room owner user ID.
-        player_list: The player list with each user ID.
+        owner_name: The room owner name.
+        player_ids: The set of the player user IDs.
+        num_players: The number of players, kept in sync with player_ids.
         status: The current room status.
+        snapshot: The room info sent through the room list. See get_room_list().
+          It should be updated by update_snapshot() after every modification.
     """
 
     class Status(enum.IntEnum):
@@ -30,36 +48,161 @@ class RoomInfo:
 
     name: str
     owner_id: int
-    player_list: list[int] = dataclasses.field(default_factory=list)
+    owner_name: str
+    player_ids: set[int] = dataclasses.field(default_factory=set)
+    num_players: int = dataclasses.field(init=False)
     status: Status = Status.WAITING
+    snapshot: dict = dataclasses.field(init=False, repr=False)
 
     def __post_init__(self):
         """Overridden.
         
-        It adds the owner to the player list.
+        It adds the owner to the player set, and initializes num_players and the snapshot.
+        """
+        self.player_ids.add(self.owner_id)
+        self.num_players = len(self.player_ids)
+        self.snapshot = {
+            "name": self.name,
+            "owner": self.owner_name,
+            "num_players": self.num_players,
+            "status": int(self.status)
+        }
+
+    def update_snapshot(self):
+        """Updates the mutable entries of the snapshot in place.
+
+        The snapshot is never replaced, so that room_snapshots can keep referring to it.
+        """
+        self.snapshot["num_players"] = self.num_players
+        self.snapshot["status"] = int(self.status)
+
+
+class ORJSONResponse(JSONResponse):
+    """JSON response serialized by orjson instead of the standard json module."""
+
+    def render(self, content) -> bytes:
+        """Overridden.
+
+        It encodes the content with orjson.
         """
-        self.player_list.append(self.owner_id)
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
+@dataclasses.dataclass
+class RoomListPayload:
+    """Serialized room list shared by every room list subscriber.
+
+    Fields:
+        json_text: The room list encoded as JSON.
+        msgpack_bytes: The room list encoded as MessagePack.
+    """
+
+    json_text: str = "[]"
+    msgpack_bytes: bytes = b"\x90"
 
 
 user_list: list[str] = []
 room_list: list[RoomInfo] = []
+room_snapshots: list[dict] = []  # The snapshot of each room, in parallel with room_list.
+room_list_payload = RoomListPayload()
+# The event of each subscriber, which is set when there is a room list not sent to it yet.
+room_list_subscribers: set[asyncio.Event] = set()
+
+
+def log_broadcaster_failure(broadcaster: asyncio.Task):
+    """Logs the error that stopped the room list broadcaster, if any.
+
+    Args:
+        broadcaster: The finished task running broadcast_room_list().
+    """
+    if not broadcaster.cancelled() and broadcaster.exception() is not None:
+        logger.error("The room list broadcaster stopped unexpectedly.",
+                     exc_info=broadcaster.exception())
+
 
-app = FastAPI()
+@contextlib.asynccontextmanager
+async def lifespan(_: FastAPI):
+    """Runs broadcast_room_list() in the background while the app is running."""
+    room_list_modified.cache_clear()
+    broadcaster = asyncio.create_task(broadcast_room_list())
+    broadcaster.add_done_callback(log_broadcaster_failure)
+    yield
+    broadcaster.cancel()
+    # A failure has already been logged by log_broadcaster_failure().
+    await asyncio.wait([broadcaster])
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 def notify_modified(modified: asyncio.Event):
-    """Sets and clears the modified event.
+    """Sets the modified event.
     
     All the coroutines that are waiting for the modified event will be awakened.
+    The waiter is responsible for clearing the event.
 
     Args:
         modified: The event to notify a modification.
     """
     modified.set()
-    modified.clear()
+
+
+def update_room_list_payload():
+    """Rebuilds the serialized room list from the current room list.
+
+    See get_room_list() for the room list format.
+    """
+    room_list_payload.json_text = orjson.dumps(room_snapshots).decode()
+    room_list_payload.msgpack_bytes = msgpack.packb(room_snapshots)
+
+
+async def send_room_list(websocket: WebSocket, pending: asyncio.Event, use_msgpack: bool):
+    """Sends the latest room list whenever the pending event is set.
+
+    A slow client skips the room lists that were replaced before it could receive them,
+    and it holds back only this coroutine.
+
+    Args:
+        websocket: The web socket object.
+        pending: The event set when there is a room list not sent yet.
+        use_msgpack: Whether to send the room list as MessagePack instead of JSON.
+    """
+    while True:
+        await pending.wait()
+        pending.clear()
+        if use_msgpack:
+            await websocket.send_bytes(room_list_payload.msgpack_bytes)
+        else:
+            await websocket.send_text(room_list_payload.json_text)
+
+
+async def wait_for_disconnect(websocket: WebSocket):
+    """Receives and ignores the messages from a client until it disconnects.
+
+    Args:
+        websocket: The web socket object.
+    """
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+
+async def broadcast_room_list():
+    """Notifies every subscriber of the new room list whenever it is modified.
+
+    After being awakened, it yields to the event loop once before serializing the room list,
+    so that the modifications made in a burst are sent to each subscriber as a single frame.
+    """
+    while True:
+        modified = room_list_modified()
+        await modified.wait()
+        await asyncio.sleep(0)
+        modified.clear()
+        update_room_list_payload()
+        for pending in room_list_subscribers:
+            pending.set()
 
 
 @app.get("/user/me/")
-async def create_user(name: str) -> int:
+async def create_user(name: str) -> ORJSONResponse:
     """Creates a new user with the given name.
     
     Args:
@@ -69,11 +212,11 @@ async def create_user(name: str) -> int:
         The created user ID.
     """
     user_list.append(name)
-    return len(user_list) - 1
+    return ORJSONResponse(len(user_list) - 1)
 
 
 @app.post("/room/")
-async def create_room(name: str, user_id: int) -> int:
+async def create_room(name: str, user_id: int) -> ORJSONResponse:
     """Creates a new room with the given name.
     
     Args:
@@ -82,12 +225,18 @@ async def create_room(name: str, user_id: int) -> int:
     Returns:
         The created room ID, or -1 if failed.
     """
-    if user_id < 0 or user_id >= len(user_list):
-        logger.exception("An unregistered user (ID: %d) tries to create a room.", user_id)
-        return -1
-    room_list.append(RoomInfo(name=name, owner_id=user_id))
-    notify_modified(room_list_modified)
-    return len(room_list) - 1
+    try:
+        if user_id < 0:  # Negative indices would wrap around.
+            raise IndexError(user_id)
+        owner_name = user_list[user_id]
+    except IndexError:
+        logger.warning("An unregistered user (ID: %d) tries to create a room.", user_id)
+        return ORJSONResponse(-1)
+    room = RoomInfo(name=name, owner_id=user_id, owner_name=owner_name)
+    room_list.append(room)
+    room_snapshots.append(room.snapshot)
+    notify_modified(room_list_modified())
+    return ORJSONResponse(len(room_list) - 1)
 
 
 @app.websocket("/room/list/")
@@ -99,25 +248,38 @@ async def get_room_list(websocket: WebSocket):
       "owner": The room owner name.
       "num_players": The number of players of the room.
       "status": The room status. See RoomInfo.Status.
+
+    The current room list is sent right after the connection is accepted, and then again
+    whenever it is modified. A client that is slow to receive gets only the latest room list.
+
+    If the client requests the "msgpack" subprotocol, the room list is sent as MessagePack
+    binary frames. Otherwise, it is sent as JSON text frames.
     
     Args:
         websocket: The web socket object. 
     """
-    await websocket.accept()
+    use_msgpack = "msgpack" in websocket.scope.get("subprotocols", [])
+    await websocket.accept(subprotocol="msgpack" if use_msgpack else None)
+    pending = asyncio.Event()
+    # If a modification is pending, it will be broadcast soon.
+    if not room_list_modified().is_set():
+        pending.set()
+    room_list_subscribers.add(pending)
+    sender = asyncio.create_task(send_room_list(websocket, pending, use_msgpack))
+    receiver = asyncio.create_task(wait_for_disconnect(websocket))
     try:
-        while True:
-            await room_list_modified.wait()
-            data = [{
-                "name": room.name,
-                "owner": user_list[room.owner_id],
-                "num_players": len(room.player_list),
-                "status": room.status.value
-            } for room in room_list]
-            await websocket.send_json(data)
-    except websockets.exceptions.ConnectionClosedError:
-        logger.info("The connection for sending the room list is closed.")
-    except websockets.exceptions.WebSocketException:
-        logger.exception("Failed to send the room list.")
+        # Returning lets the server tear down the connection, even if the client is too
+        # stalled to receive a close frame.
+        await asyncio.wait([sender, receiver], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        room_list_subscribers.discard(pending)
+        sender.cancel()
+        receiver.cancel()
+    if sender.done() and not sender.cancelled():
+        error = sender.exception()
+        if not isinstance(error, WebSocketDisconnect):
+            logger.error("Failed to send the room list.", exc_info=error)
+    logger.info("The connection for sending the room list is closed.")
 
 
 @app.post("/room/{room_id}/enter/")
@@ -132,19 +294,24 @@ async def enter_room(room_id: int, user_id: int) -> bool:
         False if either the room ID or the user ID is invalid or the game is already running.
         Otherwise, True.
     """
-    if room_id < 0 or room_id >= len(room_list):
-        logger.exception("There is no room (ID: %d).", room_id)
+    try:
+        if room_id < 0:  # Negative indices would wrap around.
+            raise IndexError(room_id)
+        room = room_list[room_id]
+    except IndexError:
+        logger.warning("There is no room (ID: %d).", room_id)
         return False
     if user_id < 0 or user_id >= len(user_list):
-        logger.exception("An unregistered user (ID: %d) tries to enter a room.", user_id)
+        logger.warning("An unregistered user (ID: %d) tries to enter a room.", user_id)
         return False
-    room = room_list[room_id]
     if room.status == RoomInfo.Status.RUNNING:
-        logger.exception("The room (ID: %d) is already running.", room_id)
+        logger.warning("The room (ID: %d) is already running.", room_id)
         return False
-    if user_id in room.player_list:
-        logger.exception("The user (ID: %d) is already in the room (ID: %d).", user_id, room_id)
+    if user_id in room.player_ids:
+        logger.warning("The user (ID: %d) is already in the room (ID: %d).", user_id, room_id)
         return False
-    room.player_list.append(user_id)
-    notify_modified(room_list_modified)
+    room.player_ids.add(user_id)
+    room.num_players += 1
+    room.update_snapshot()
+    notify_modified(room_list_modified())
     return True
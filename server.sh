@@ -1 +1 @@
-python3 -m uvicorn main:app --reload --host 0.0.0.0 --port 8000
\ No newline at end of file
+python3 -m uvicorn main:app --reload --host 0.0.0.0 --port 8000 --loop uvloop --http httptools --ws-per-message-deflate false
\ No newline at end of file
@@ -0,0 +1,90 @@
+"""Tests for the backend server."""
+
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+def test_room_list_after_restart():
+    """The room list is broadcast every time the app starts on a new event loop."""
+    for _ in range(2):
+        with TestClient(main.app) as client:
+            with client.websocket_connect("/room/list/") as websocket:
+                websocket.receive_json()
+                user_id = client.get("/user/me/", params={"name": "user"}).json()
+                client.post("/room/", params={"name": "room", "user_id": user_id})
+                assert websocket.receive_json()[-1]["name"] == "room"
+
+
+class FakeWebSocket:
+    """Web socket whose client never sends anything and records the sent messages."""
+
+    def __init__(self):
+        self.scope = {"subprotocols": []}
+        self.sent = []
+
+    async def accept(self, **_):
+        """Accepts the connection."""
+
+    async def send_text(self, data: str):
+        """Records the message."""
+        self.sent.append(data)
+
+    async def receive(self):
+        """Waits forever, as a client that never sends anything does."""
+        await asyncio.Event().wait()
+
+
+class BrokenWebSocket(FakeWebSocket):
+    """Web socket that fails to send after the first message."""
+
+    async def send_text(self, data: str):
+        """Fails except for the first call."""
+        if self.sent:
+            raise RuntimeError("The connection is broken.")
+        await super().send_text(data)
+
+
+class StalledWebSocket(FakeWebSocket):
+    """Web socket whose client stops reading after the first message."""
+
+    async def send_text(self, data: str):
+        """Blocks forever except for the first call."""
+        if self.sent:
+            await asyncio.Event().wait()
+        await super().send_text(data)
+
+
+def test_dropped_subscriber():
+    """The room list handler returns when its subscriber fails to receive the room list."""
+    async def run():
+        async with main.lifespan(main.app):
+            websocket = BrokenWebSocket()
+            handler = asyncio.create_task(main.get_room_list(websocket))
+            await asyncio.sleep(0.1)
+            main.notify_modified(main.room_list_modified())
+            await asyncio.wait_for(handler, 1)
+            assert len(websocket.sent) == 1
+
+    asyncio.run(run())
+
+
+def test_stalled_subscriber():
+    """A stalled subscriber does not hold back the room list for the others."""
+    async def run():
+        async with main.lifespan(main.app):
+            stalled = StalledWebSocket()
+            websocket = FakeWebSocket()
+            handlers = [asyncio.create_task(main.get_room_list(stalled)),
+                        asyncio.create_task(main.get_room_list(websocket))]
+            await asyncio.sleep(0.1)
+            for _ in range(2):
+                main.notify_modified(main.room_list_modified())
+                await asyncio.sleep(0.1)
+            assert len(websocket.sent) == 3
+            for handler in handlers:
+                handler.cancel()
+
+    asyncio.run(run())